@@ -5,35 +5,86 @@ with custom instructions injected into the conversation.
 """
 
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from pydantic import BaseModel, Field, model_validator
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    LogitsProcessorList,
+    PreTrainedTokenizerFast,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
 import torch
 from typing import Optional
 from contextlib import asynccontextmanager
-import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import asyncio
 import os
 
-# System instructions that will be injected into every conversation
+# System instructions that will be injected into every conversation.
+# Updates rebind the whole string, which is atomic, so readers take no lock.
 SYSTEM_INSTRUCTIONS = """You are WromGPT, a helpful and knowledgeable AI assistant.
 You provide accurate, concise, and helpful responses to user queries.
 Always maintain a professional and friendly tone."""
 
-# Thread lock for safe instruction updates
-instructions_lock = threading.Lock()
-
 # Model configuration
 MODEL_NAME = os.getenv("MODEL_NAME", "gpt2")  # Default to GPT-2, can be changed
 AI_MODEL = os.getenv("AI_MODEL", "wromgpt")  # Logical AI model name for clients
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))  # Sequences per generate call
+MAX_BATCH_DELAY = float(os.getenv("MAX_BATCH_DELAY", 0.05))  # Seconds to wait for a batch to fill
+MAX_MESSAGE_CHARS = int(os.getenv("MAX_MESSAGE_CHARS", 10000))  # Longest accepted message text
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", 512))  # Prompt tokens kept after truncation
+MIN_MESSAGE_TOKENS = int(os.getenv("MIN_MESSAGE_TOKENS", MAX_INPUT_TOKENS // 4))  # Prompt room kept for the message
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", 512))  # Upper bound for max_new_tokens
+MODEL_DTYPE = os.getenv("MODEL_DTYPE", "auto")  # "auto", "bfloat16", "float16" or "float32"
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# "auto" compiles only on GPU hosts, where kernel launch overhead dominates decoding
+COMPILE_MODEL = os.getenv("COMPILE_MODEL", "auto")
+# Serve CPU-only hosts through an ONNX Runtime export (needs optimum[onnxruntime])
+ONNX_RUNTIME = os.getenv("ONNX_RUNTIME", "0").lower() in ("1", "true", "yes")
 tokenizer = None
 model = None
 
+# Longest prompt plus reply the model's position table can hold (None if unbounded)
+max_sequence_len = None
+
+# Persistent host buffers that batched input ids and attention masks are copied into
+input_buffer = None
+mask_buffer = None
+
+# Uncompiled forward pass kept while the model runs compiled (None if not compiled)
+eager_forward = None
+
+# Whether generation runs under CPU bf16 autocast (set when IPEX optimizes the model)
+cpu_autocast = False
+
+# Token ids of the separator between the user message and the model's reply
+assistant_ids = []
+
+# Pending (ChatRequest, response queue) pairs consumed by server_loop
+model_queue = None
+
+# Single worker thread so all model work stays on one thread (created per lifespan)
+model_executor = None
+
 
 class ChatRequest(BaseModel):
     """Request model for chat endpoint"""
-    message: str
-    max_length: Optional[int] = 200
+    message: str = Field(..., max_length=MAX_MESSAGE_CHARS)
+    max_new_tokens: int = Field(200, ge=1, le=MAX_NEW_TOKENS)
     temperature: Optional[float] = 0.7
-    custom_instructions: Optional[str] = None
+    deterministic: bool = False
+    custom_instructions: Optional[str] = Field(None, max_length=MAX_MESSAGE_CHARS)
+
+    @model_validator(mode="before")
+    @classmethod
+    def reject_max_length(cls, data):
+        """Fail loudly for clients still sending the removed max_length field"""
+        if isinstance(data, dict) and "max_length" in data:
+            raise ValueError("max_length is no longer supported, use max_new_tokens instead")
+        return data
 
 
 class ChatResponse(BaseModel):
@@ -44,21 +95,131 @@ class ChatResponse(BaseModel):
 
 class InstructionsRequest(BaseModel):
     """Request model for updating system instructions"""
-    instructions: str
+    instructions: str = Field(..., max_length=MAX_MESSAGE_CHARS)
+
+
+MODEL_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    "float32": torch.float32,
+}
+
+
+def cpu_has_native_bf16():
+    """Check the CPU flags for native bf16 instructions (AVX-512 BF16 / AMX-BF16, Linux only)"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read().split()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def select_dtype():
+    """Pick the weight dtype for the inference device"""
+    if MODEL_DTYPE != "auto":
+        if MODEL_DTYPE not in MODEL_DTYPES:
+            raise ValueError(
+                f"Invalid MODEL_DTYPE {MODEL_DTYPE!r}, expected one of: auto, {', '.join(MODEL_DTYPES)}"
+            )
+        return MODEL_DTYPES[MODEL_DTYPE]
+    
+    if DEVICE == "cuda":
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    
+    # Other CPUs would emulate bf16, which is slower than float32
+    return torch.bfloat16 if cpu_has_native_bf16() else torch.float32
+
+
+def load_onnx_model():
+    """Export the model to ONNX and load it with ONNX Runtime, or None if unavailable"""
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError:
+        print("optimum[onnxruntime] is not installed, using PyTorch")
+        return None
+    
+    print("Exporting model to ONNX Runtime")
+    return ORTModelForCausalLM.from_pretrained(MODEL_NAME, export=True, use_cache=True)
+
+
+def optimize_for_cpu(model):
+    """Rewrite the model's layers to Intel bf16 (AMX/AVX-512) kernels, if IPEX is installed"""
+    global cpu_autocast
+    
+    try:
+        import intel_extension_for_pytorch as ipex
+    except ImportError:
+        return model
+    
+    print("Optimizing model with Intel Extension for PyTorch")
+    cpu_autocast = True
+    return ipex.optimize(model, dtype=torch.bfloat16)
+
+
+def convert_to_fast_tokenizer(slow_tokenizer):
+    """Build a Rust-backed fast tokenizer equivalent to a slow (Python) one"""
+    from transformers.convert_slow_tokenizer import convert_slow_tokenizer
+    
+    return PreTrainedTokenizerFast(
+        tokenizer_object=convert_slow_tokenizer(slow_tokenizer),
+        model_max_length=slow_tokenizer.model_max_length,
+        **slow_tokenizer.special_tokens_map
+    )
 
 
 def load_model():
     """Load the Hugging Face model and tokenizer"""
-    global tokenizer, model
+    global tokenizer, model, assistant_ids, cpu_autocast, input_buffer, mask_buffer, max_sequence_len
     
     try:
         print(f"Loading model: {MODEL_NAME}")
         tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-        model = AutoModelForCausalLM.from_pretrained(MODEL_NAME)
+        
+        # Batched prompts are tokenized in one call, which only pays off with a fast tokenizer
+        if not tokenizer.is_fast:
+            print("No fast tokenizer available, converting the slow one")
+            try:
+                tokenizer = convert_to_fast_tokenizer(tokenizer)
+            except Exception as e:
+                print(f"Could not convert the tokenizer: {e}")
+            if not tokenizer.is_fast:
+                print("Warning: using a slow tokenizer, batched tokenization will be slower")
+        
+        model = load_onnx_model() if ONNX_RUNTIME and DEVICE == "cpu" else None
+        if model is None:
+            # Load weights in reduced precision to halve memory traffic during generation
+            dtype = select_dtype()
+            print(f"Using device: {DEVICE}, dtype: {dtype}")
+            model = AutoModelForCausalLM.from_pretrained(
+                MODEL_NAME,
+                torch_dtype=dtype,
+                low_cpu_mem_usage=True
+            ).to(DEVICE).eval()
+            
+            cpu_autocast = False
+            if DEVICE == "cpu" and dtype == torch.bfloat16:
+                model = optimize_for_cpu(model)
+        
+        # Positions past the model's table index out of range (a device-side assert on CUDA)
+        max_sequence_len = getattr(model.config, "max_position_embeddings", None)
         
         # Set pad token if not set
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+
+        # Pad on the left so generated tokens line up across a batch
+        tokenizer.padding_side = "left"
+        
+        # Cached prompt pieces depend on the tokenizer
+        encode_prefix.cache_clear()
+        assistant_ids = tokenizer("\n\nAssistant:", add_special_tokens=False).input_ids
+
+        # Flat so any [batch, length] view of the front is contiguous; pinned for async copies.
+        # Prompts are truncated to MAX_INPUT_TOKENS, so that bounds the length.
+        buffer_size = MAX_BATCH_SIZE * MAX_INPUT_TOKENS
+        input_buffer = torch.zeros(buffer_size, dtype=torch.long, pin_memory=DEVICE == "cuda")
+        mask_buffer = torch.zeros(buffer_size, dtype=torch.long, pin_memory=DEVICE == "cuda")
             
         print("Model loaded successfully!")
     except Exception as e:
@@ -66,14 +227,274 @@ def load_model():
         raise
 
 
+@lru_cache(maxsize=32)
+def encode_prefix(instructions: str) -> tuple:
+    """
+    Tokenize the instruction prefix of a prompt, cached since instructions rarely change
+    
+    Returns:
+        The prefix token ids and the number of leading special tokens among them
+    """
+    # Only the prefix starts the prompt, so only it gets special tokens such as BOS
+    ids = tuple(tokenizer(f"{instructions}\n\nUser:").input_ids)
+    
+    special_ids = set(tokenizer.all_special_ids)
+    lead = 0
+    while lead < len(ids) and ids[lead] in special_ids:
+        lead += 1
+    return ids, lead
+
+
+def decoding_temperature(request: ChatRequest) -> Optional[float]:
+    """Sampling temperature for a request, or None if it should be decoded greedily"""
+    if request.deterministic or request.temperature is None or request.temperature <= 0:
+        return None
+    return request.temperature
+
+
+@lru_cache(maxsize=16)
+def sampling_processors(temperature: float) -> LogitsProcessorList:
+    """Build the sampling warpers for a temperature once and reuse them across requests"""
+    return LogitsProcessorList([
+        TemperatureLogitsWarper(temperature),
+        TopKLogitsWarper(50),
+        TopPLogitsWarper(0.9),
+    ])
+
+
+def build_prompt_ids(instructions: str, message_ids: list) -> list:
+    """Assemble the token ids of a prompt, truncated to MAX_INPUT_TOKENS"""
+    prefix_ids, lead = encode_prefix(instructions)
+    prefix_ids = list(prefix_ids)
+    budget = MAX_INPUT_TOKENS - len(assistant_ids)
+    
+    # Shorten the message first, but always keep room for its start so it is never dropped;
+    # instructions too long to leave that room lose their start, after leading special tokens
+    # such as BOS
+    message_budget = min(max(budget - len(prefix_ids), MIN_MESSAGE_TOKENS), budget - lead)
+    message_ids = message_ids[:message_budget]
+    overflow = len(prefix_ids) + len(message_ids) - budget
+    if overflow > 0:
+        prefix_ids = prefix_ids[:lead] + prefix_ids[lead + overflow:]
+    return prefix_ids + message_ids + assistant_ids
+
+
+def generate_batch(requests: list, instructions: list) -> list:
+    """Run the model on a batch of chat requests sharing a decoding mode (blocking)"""
+    # Tokenize only the user messages; instruction prefix and separator ids are cached
+    message_ids = tokenizer(
+        [f" {request.message}" for request in requests],
+        add_special_tokens=False,
+        truncation=True,
+        max_length=MAX_INPUT_TOKENS
+    ).input_ids
+    
+    # Construct the prompts with injected instructions
+    prompt_ids = [
+        build_prompt_ids(instr, ids)
+        for instr, ids in zip(instructions, message_ids)
+    ]
+    batch_size = len(prompt_ids)
+    length = max(len(ids) for ids in prompt_ids)
+    
+    # Generate up to the longest requested reply; shorter ones are cut back when decoding.
+    # Generated tokens must fit in the model's position table alongside the prompt.
+    first = requests[0]
+    max_new_tokens = max(request.max_new_tokens for request in requests)
+    if max_sequence_len is not None:
+        max_new_tokens = min(max_new_tokens, max_sequence_len - length)
+        if max_new_tokens < 1:
+            raise ValueError(f"Prompt is too long ({length} tokens)")
+    
+    # Copy the prompts into the persistent input buffers, writing the id lists
+    # through a NumPy view so no intermediate tensor is built per row
+    input_ids = input_buffer[:batch_size * length].view(batch_size, length)
+    attention_mask = mask_buffer[:batch_size * length].view(batch_size, length)
+    ids_array = input_ids.numpy()
+    if batch_size == 1:
+        # A lone prompt already has the batch length, so there is nothing to pad
+        ids_array[0] = prompt_ids[0]
+        attention_mask.fill_(1)
+    else:
+        # Left-pad shorter prompts so generated tokens line up across the batch
+        input_ids.fill_(tokenizer.pad_token_id)
+        attention_mask.zero_()
+        for row, ids in enumerate(prompt_ids):
+            ids_array[row, length - len(ids):] = ids
+            attention_mask[row, length - len(ids):] = 1
+    
+    # Move inputs to the model's device; the buffers are pinned so the copy is asynchronous
+    input_ids = input_ids.to(DEVICE, non_blocking=True)
+    attention_mask = attention_mask.to(DEVICE, non_blocking=True)
+    
+    # Greedy decoding skips the per-step softmax and sort over the vocabulary
+    temperature = decoding_temperature(first)
+    if temperature is None:
+        decoding = {"do_sample": False, "num_beams": 1}
+    else:
+        # top_k=0 stops generate() from adding its default top-k warper on top of ours
+        decoding = {"do_sample": True, "top_k": 0, "logits_processor": sampling_processors(temperature)}
+    
+    # Generate responses, reusing cached keys/values of earlier tokens at each step
+    generate_kwargs = dict(
+        attention_mask=attention_mask,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        num_return_sequences=1,
+        use_cache=True,
+        **decoding
+    )
+    with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=cpu_autocast):
+        try:
+            outputs = model.generate(input_ids, **generate_kwargs)
+        except Exception as e:
+            if eager_forward is None:
+                raise
+            # Dynamo is only loaded once the model is compiled, so import its errors here
+            from torch._dynamo.exc import TorchDynamoException
+            if not isinstance(e, TorchDynamoException):
+                raise
+            # Last resort: warmup covers single prompts and full batches, so this should not happen
+            print(f"Error in compiled model, falling back to eager mode: {e}")
+            restore_eager_forward()
+            outputs = model.generate(input_ids, **generate_kwargs)
+    
+    # Decode only the generated tokens (left padding makes them start at the same offset),
+    # up to each request's own max_new_tokens
+    generated_ids = outputs[:, input_ids.shape[1]:]
+    return [
+        response_text.strip()
+        for response_text in tokenizer.batch_decode(
+            [ids[:request.max_new_tokens] for ids, request in zip(generated_ids, requests)],
+            skip_special_tokens=True
+        )
+    ]
+
+
+def warmup_model():
+    """Run throwaway generations at two prompt lengths and a full batch before serving requests"""
+    # Absorbs kernel selection, allocator growth and (if compiled) dynamic shape specialization
+    messages = ["Hello!", "Can you explain how large language models generate text, one token at a time?"]
+    for message in messages:
+        generate_batch([ChatRequest(message=message, max_new_tokens=8)], [SYSTEM_INSTRUCTIONS])
+    
+    # Dynamo specializes size-1 dimensions, so batches need their own (padded) warmup
+    if MAX_BATCH_SIZE > 1:
+        requests = [
+            ChatRequest(message=messages[i % len(messages)], max_new_tokens=8)
+            for i in range(MAX_BATCH_SIZE)
+        ]
+        generate_batch(requests, [SYSTEM_INSTRUCTIONS] * MAX_BATCH_SIZE)
+    print("Model warmed up!")
+
+
+def should_compile():
+    """Decide whether to compile the model with torch.compile"""
+    # ONNX Runtime models are already optimized graphs, not PyTorch modules
+    if not isinstance(model, torch.nn.Module):
+        return False
+    
+    if COMPILE_MODEL == "auto":
+        return DEVICE == "cuda"
+    return COMPILE_MODEL.lower() in ("1", "true", "yes")
+
+
+def restore_eager_forward():
+    """Switch the model back to its uncompiled forward pass"""
+    global eager_forward
+    model.forward = eager_forward
+    eager_forward = None
+
+
+def compile_model():
+    """Compile the model's forward pass, falling back to eager mode on failure"""
+    global eager_forward
+    eager_forward = model.forward
+    try:
+        # Default mode: CUDA graphs would be re-recorded for every length the KV cache grows to
+        model.forward = torch.compile(eager_forward, fullgraph=False, dynamic=True)
+        
+        # Compilation happens lazily on the first calls, so pay for it before serving
+        warmup_model()
+        print("Model compiled successfully!")
+    except Exception as e:
+        print(f"Error compiling model, falling back to eager mode: {e}")
+        restore_eager_forward()
+        warmup_model()
+
+
+async def collect_batch(queue: asyncio.Queue) -> list:
+    """Wait for a request, then gather more until the batch is full or the delay expires"""
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    deadline = loop.time() + MAX_BATCH_DELAY
+    
+    while len(batch) < MAX_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    
+    return batch
+
+
+async def server_loop(queue: asyncio.Queue):
+    """Consume chat requests in batches and run them on the model thread"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await collect_batch(queue)
+        
+        # Snapshot system instructions once for the whole batch
+        system_instructions = SYSTEM_INSTRUCTIONS
+        
+        # Requests can only share a generate call if their decoding mode and temperature match
+        groups = {}
+        for request, response_q in batch:
+            groups.setdefault(decoding_temperature(request), []).append((request, response_q))
+        
+        for items in groups.values():
+            requests = [request for request, _ in items]
+            # Use custom instructions if provided, otherwise use system instructions
+            instructions = [
+                request.custom_instructions if request.custom_instructions else system_instructions
+                for request in requests
+            ]
+            
+            try:
+                results = await loop.run_in_executor(model_executor, generate_batch, requests, instructions)
+            except Exception as e:
+                results = [e] * len(items)
+            
+            for (_, response_q), result in zip(items, results):
+                response_q.put_nowait(result)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handle startup and shutdown events"""
-    # Startup: Load model
+    global model_queue, model_executor
+    
+    # Startup: Load model and start the inference worker
     load_model()
+    model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+    
+    # Pay first-call costs on the model thread before the first real request
+    loop = asyncio.get_running_loop()
+    if should_compile():
+        # Compiling warms up too
+        await loop.run_in_executor(model_executor, compile_model)
+    else:
+        await loop.run_in_executor(model_executor, warmup_model)
+    model_queue = asyncio.Queue()
+    worker = asyncio.create_task(server_loop(model_queue))
     yield
-    # Shutdown: cleanup if needed
-    pass
+    # Shutdown: stop the inference worker
+    worker.cancel()
+    model_executor.shutdown(wait=False)
 
 
 app = FastAPI(
@@ -131,51 +552,24 @@ async def chat(request: ChatRequest):
     if model is None or tokenizer is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
-    try:
-        # Use custom instructions if provided, otherwise use system instructions
-        with instructions_lock:
-            instructions = request.custom_instructions if request.custom_instructions else SYSTEM_INSTRUCTIONS
-        
-        # Construct the prompt with injected instructions
-        prompt = f"{instructions}\n\nUser: {request.message}\n\nAssistant:"
-        
-        # Tokenize the input
-        inputs = tokenizer(prompt, return_tensors="pt", padding=True)
-        
-        # Generate response
-        with torch.no_grad():
-            outputs = model.generate(
-                inputs.input_ids,
-                max_length=request.max_length,
-                temperature=request.temperature,
-                do_sample=True,
-                pad_token_id=tokenizer.pad_token_id,
-                eos_token_id=tokenizer.eos_token_id,
-                top_p=0.9,
-                num_return_sequences=1
-            )
-        
-        # Decode the response
-        response_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        # Extract only the assistant's response (remove the prompt)
-        if "Assistant:" in response_text:
-            response_text = response_text.split("Assistant:")[-1].strip()
-        
-        return ChatResponse(
-            response=response_text,
-            model_used=MODEL_NAME
-        )
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+    # Hand the request to the inference worker and wait for its result
+    response_q = asyncio.Queue()
+    await model_queue.put((request, response_q))
+    result = await response_q.get()
+    
+    if isinstance(result, Exception):
+        raise HTTPException(status_code=500, detail=f"Error generating response: {str(result)}")
+    
+    return ChatResponse(
+        response=result,
+        model_used=MODEL_NAME
+    )
 
 
 @app.get("/api/instructions")
 async def get_instructions():
     """Get current system instructions"""
-    with instructions_lock:
-        return {"instructions": SYSTEM_INSTRUCTIONS}
+    return {"instructions": SYSTEM_INSTRUCTIONS}
 
 
 @app.post("/api/instructions")
@@ -190,13 +584,12 @@ async def update_instructions(request: InstructionsRequest):
         Confirmation message
     """
     global SYSTEM_INSTRUCTIONS
-    with instructions_lock:
-        SYSTEM_INSTRUCTIONS = request.instructions
-        return {
-            "status": "success",
-            "message": "System instructions updated",
-            "instructions": SYSTEM_INSTRUCTIONS
-        }
+    SYSTEM_INSTRUCTIONS = request.instructions
+    return {
+        "status": "success",
+        "message": "System instructions updated",
+        "instructions": request.instructions
+    }
 
 
 if __name__ == "__main__":
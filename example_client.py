@@ -26,13 +26,13 @@ def test_root():
     print(f"Response: {json.dumps(response.json(), indent=2)}")
 
 
-def test_chat(message, max_length=100, temperature=0.7, custom_instructions=None):
+def test_chat(message, max_new_tokens=100, temperature=0.7, custom_instructions=None):
     """Test the chat endpoint"""
     print(f"\n=== Testing Chat: '{message}' ===")
     
     payload = {
         "message": message,
-        "max_length": max_length,
+        "max_new_tokens": max_new_tokens,
         "temperature": temperature
     }
     
@@ -89,12 +89,12 @@ def main():
         test_get_instructions()
         
         # Test chat with default instructions
-        test_chat("Hello! What is your purpose?", max_length=150)
+        test_chat("Hello! What is your purpose?", max_new_tokens=150)
         
         # Test chat with custom instructions
         test_chat(
             "What is Python?",
-            max_length=150,
+            max_new_tokens=150,
             custom_instructions="You are a Python programming expert. Be concise and technical."
         )
         
@@ -104,7 +104,7 @@ def main():
         )
         
         # Test chat with updated instructions
-        test_chat("Tell me about machine learning", max_length=150)
+        test_chat("Tell me about machine learning", max_new_tokens=150)
         
         print("\n" + "=" * 60)
         print("All tests completed!")